@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2025 Davide Truffa <davide@catoblepa.org>
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from email import policy
+from email.errors import HeaderParseError, MessageError
+from email.parser import BytesHeaderParser
+import binascii
+import lzma
+import os
+import sys
+import tarfile
+import zipfile
+import zlib
+
+from signature_parser import (
+    _, MAX_BYTE_ANALIZZATI, analizza_buste_annidate, stampa_risultati
+)
+
+# MIME types used for P7M attachments
+TIPI_MIME_P7M = ('application/pkcs7-mime', 'application/x-pkcs7-mime')
+
+# Maximum length of a line, and of a header block, read from a MIME message
+DIMENSIONE_BLOCCO = 1024 * 1024
+
+# Errors raised while reading a damaged archive or message
+ERRORI_ARCHIVIO = (zipfile.BadZipFile, tarfile.TarError, OSError, EOFError,
+                   zlib.error, lzma.LZMAError, binascii.Error, MessageError)
+
+# Errors raised by zipfile for members it cannot read, such as encrypted
+# members or unsupported compression methods
+ERRORI_MEMBRO_ZIP = ERRORI_ARCHIVIO + (RuntimeError, NotImplementedError)
+
+def _e_p7m(nome):
+    return nome.lower().endswith('.p7m')
+
+def _e_eml(nome):
+    return nome.lower().endswith('.eml')
+
+def _e_tar(nome):
+    nome = nome.lower()
+    return nome.endswith(('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz'))
+
+def _interruzione(motivo, dettaglio):
+    return {'motivo': motivo, 'livello': 1, 'dettaglio': dettaglio}
+
+def _troppo_grande(nome, max_byte):
+    return nome, None, _interruzione('byte', _('Analyzed data exceeds %d bytes') % max_byte)
+
+def _non_valido(nome, errore):
+    return nome, None, _interruzione(
+        'archivio_non_valido', f"{_('Invalid archive member')}: {errore}")
+
+class _ParteP7M:
+    """
+    Decode the body of a P7M MIME part one line at a time.
+    """
+    def __init__(self, nome, codifica, max_byte):
+        self.nome = nome
+        self.codifica = codifica
+        self.max_byte = max_byte
+        self.dati = bytearray()
+        self.residuo = b''
+        self.fine_riga = b''
+        self.troppo_grande = False
+
+    def aggiungi(self, riga):
+        if self.troppo_grande:
+            return
+        if self.codifica == 'base64':
+            self.residuo += b''.join(riga.split())
+            n_caratteri = len(self.residuo) // 4 * 4
+            self.dati += binascii.a2b_base64(self.residuo[:n_caratteri])
+            self.residuo = self.residuo[n_caratteri:]
+        else:
+            # The line break before a boundary belongs to the boundary
+            contenuto = riga.rstrip(b'\r\n')
+            self.dati += self.fine_riga
+            self.fine_riga = riga[len(contenuto):]
+            if self.codifica == 'quoted-printable':
+                if contenuto.endswith(b'='):
+                    contenuto, self.fine_riga = contenuto[:-1], b''
+                contenuto = binascii.a2b_qp(contenuto)
+            self.dati += contenuto
+        self.troppo_grande = len(self.dati) > self.max_byte
+
+    def chiudi(self):
+        if not self.troppo_grande and self.residuo:
+            self.dati += binascii.a2b_base64(self.residuo)
+        if self.troppo_grande or len(self.dati) > self.max_byte:
+            return _troppo_grande(self.nome, self.max_byte)
+        return self.nome, bytes(self.dati), None
+
+def buste_da_eml(stream, nome_messaggio, max_byte=MAX_BYTE_ANALIZZATI):
+    """
+    Extract the P7M attachments of a MIME message (e.g. a PEC .eml file).
+    The message is read one line at a time: only the P7M part being decoded
+    is kept in memory, and every other part is skipped.
+    Yields (name, data, interruption) for every attachment, as trova_buste.
+    """
+    parser = BytesHeaderParser(policy=policy.default)
+    confini = []
+    intestazione = b''
+    stato = 'intestazione'
+    parte = None
+    n_parti = 0
+
+    while True:
+        riga = stream.readline(DIMENSIONE_BLOCCO)
+        if not riga:
+            break
+
+        # A boundary line of any open multipart ends the current part
+        confine = riga.rstrip()
+        if stato != 'intestazione' and confine.startswith(b'--'):
+            trovato = next((b for b in reversed(confini)
+                            if confine in (b'--' + b, b'--' + b + b'--')), None)
+            if trovato is not None:
+                if parte is not None:
+                    yield parte.chiudi()
+                    parte = None
+                del confini[confini.index(trovato) + 1:]
+                if confine.endswith(b'--') and confine != b'--' + trovato:
+                    confini.pop()
+                    stato = 'salta'
+                else:
+                    stato = 'intestazione'
+                continue
+
+        if stato == 'salta':
+            continue
+        if stato == 'corpo':
+            parte.aggiungi(riga)
+            continue
+
+        if riga.strip():
+            intestazione += riga
+            if len(intestazione) > DIMENSIONE_BLOCCO:
+                raise HeaderParseError(_('MIME header too long'))
+            continue
+        intestazioni = parser.parsebytes(intestazione)
+        intestazione = b''
+        tipo = intestazioni.get_content_type()
+        if intestazioni.get_content_maintype() == 'multipart':
+            confine_parte = intestazioni.get_boundary()
+            if confine_parte is not None:
+                confini.append(confine_parte.encode('latin-1', errors='replace'))
+            stato = 'salta'
+        elif tipo == 'message/rfc822':
+            # postacert.eml and other attached messages: their headers follow
+            stato = 'intestazione'
+        else:
+            n_parti += 1
+            nome_parte = intestazioni.get_filename() or ''
+            if _e_p7m(nome_parte) or tipo in TIPI_MIME_P7M:
+                parte = _ParteP7M(
+                    f"{nome_messaggio}/{nome_parte or f'part{n_parti}.p7m'}",
+                    intestazioni.get('content-transfer-encoding', '7bit').strip().lower(),
+                    max_byte)
+                stato = 'corpo'
+            else:
+                stato = 'salta'
+
+    if parte is not None:
+        yield parte.chiudi()
+
+def _buste_da_membro(nome, stream, dimensione, max_byte):
+    """
+    Yield (name, data, interruption) for an archive member, if it is a P7M
+    file or a MIME message.
+    """
+    if _e_p7m(nome):
+        if dimensione > max_byte:
+            yield _troppo_grande(nome, max_byte)
+        else:
+            yield nome, stream.read(), None
+    elif _e_eml(nome):
+        yield from buste_da_eml(stream, nome, max_byte)
+
+def buste_da_zip(percorso, max_byte=MAX_BYTE_ANALIZZATI):
+    """
+    Yield (name, data, interruption) for every P7M envelope contained in a
+    ZIP archive. A damaged member is reported and the next one is read.
+    """
+    nome_archivio = os.path.basename(percorso)
+    try:
+        archivio = zipfile.ZipFile(percorso)
+    except ERRORI_ARCHIVIO as e:
+        yield _non_valido(nome_archivio, e)
+        return
+    with archivio:
+        for membro in archivio.infolist():
+            if membro.is_dir():
+                continue
+            nome = f"{nome_archivio}/{membro.filename}"
+            try:
+                with archivio.open(membro) as stream:
+                    yield from _buste_da_membro(nome, stream, membro.file_size, max_byte)
+            except ERRORI_MEMBRO_ZIP as e:
+                yield _non_valido(nome, e)
+
+def buste_da_tar(percorso, max_byte=MAX_BYTE_ANALIZZATI):
+    """
+    Yield (name, data, interruption) for every P7M envelope contained in a
+    tar archive. The archive is read sequentially, so compressed tarballs are
+    never seeked; for the same reason reading stops at the first damaged block.
+    """
+    nome_archivio = os.path.basename(percorso)
+    nome = nome_archivio
+    try:
+        with tarfile.open(percorso, 'r|*') as archivio:
+            for membro in archivio:
+                if not membro.isfile():
+                    continue
+                nome = f"{nome_archivio}/{membro.name}"
+                stream = archivio.extractfile(membro)
+                yield from _buste_da_membro(nome, stream, membro.size, max_byte)
+                nome = nome_archivio
+    except ERRORI_ARCHIVIO as e:
+        yield _non_valido(nome, e)
+
+def trova_buste(percorso, max_byte=MAX_BYTE_ANALIZZATI):
+    """
+    Yield (name, data, interruption) for every P7M envelope found in a file.
+    Plain P7M files, tar and ZIP archives and MIME messages (.eml) are
+    supported; a .p7m file is always an envelope, even when it wraps a ZIP.
+    data is None, and interruption has the same structure as the one returned
+    by analizza_buste_annidate, when the envelope is larger than max_byte or
+    could not be read.
+    """
+    nome = os.path.basename(percorso)
+    if _e_tar(nome):
+        yield from buste_da_tar(percorso, max_byte)
+    elif _e_eml(nome):
+        try:
+            with open(percorso, 'rb') as f:
+                yield from buste_da_eml(f, nome, max_byte)
+        except ERRORI_ARCHIVIO as e:
+            yield _non_valido(nome, e)
+    elif not _e_p7m(nome) and zipfile.is_zipfile(percorso):
+        yield from buste_da_zip(percorso, max_byte)
+    elif os.path.getsize(percorso) > max_byte:
+        yield _troppo_grande(nome, max_byte)
+    else:
+        with open(percorso, 'rb') as f:
+            yield nome, f.read(), None
+
+def _analizza_membro(nome, data, max_byte):
+    return nome, analizza_buste_annidate(data, max_byte=max_byte)
+
+def _risultato(futuro, nome):
+    try:
+        return futuro.result()
+    except Exception as e:
+        return nome, {'firme': [], 'interruzione': _interruzione('errore_analisi', str(e))}
+
+def analizza_archivio(percorso, max_processi=None, max_byte=MAX_BYTE_ANALIZZATI):
+    """
+    Analyze every P7M envelope found in a file, using a pool of processes.
+    At most two envelopes per process are kept in memory at the same time.
+    Yields (name, analysis) in completion order, where analysis is the
+    dictionary returned by analizza_buste_annidate. Envelopes that could not
+    be read or analyzed are reported with the 'archivio_non_valido' or
+    'errore_analisi' interruption, and the audit goes on.
+    """
+    max_processi = max_processi or os.cpu_count() or 1
+    in_corso = {}
+    errore = None
+    with ProcessPoolExecutor(max_processi) as executor:
+        try:
+            for nome, data, interruzione in trova_buste(percorso, max_byte):
+                if interruzione is not None:
+                    yield nome, {'firme': [], 'interruzione': interruzione}
+                    continue
+                if len(in_corso) >= 2 * max_processi:
+                    completati = wait(in_corso, return_when=FIRST_COMPLETED).done
+                    for futuro in completati:
+                        yield _risultato(futuro, in_corso.pop(futuro))
+                in_corso[executor.submit(_analizza_membro, nome, data, max_byte)] = nome
+        except Exception as e:
+            errore = e
+        # Results already submitted are reported even if reading fails
+        for futuro in wait(in_corso).done:
+            yield _risultato(futuro, in_corso[futuro])
+    if errore is not None:
+        raise errore
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(_('Usage: python archivi.py archive.zip|archive.tar|message.eml'))
+        sys.exit(1)
+    else:
+        for nome, analisi in analizza_archivio(sys.argv[1]):
+            print(f"\n=== {nome} ===")
+            stampa_risultati(analisi['firme'])
+            if analisi['interruzione'] is not None:
+                print(f"\n{_('Analysis interrupted')}: {analisi['interruzione']['dettaglio']}")
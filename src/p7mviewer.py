@@ -12,7 +12,7 @@ from pathlib import Path
 import gettext
 import locale
 
-from signature_parser import analizza_busta
+from signature_parser import analizza_buste_annidate
 
 # Setup localization
 APP_ID = "io.github.catoblepa.p7mviewer"
@@ -305,12 +305,18 @@ class FirmeWindow(Gtk.ApplicationWindow):
         try:
             with open(file_p7m, 'rb') as f:
                 data = f.read()
-            firme_info = analizza_busta(data)
+            analisi = analizza_buste_annidate(data)
+            firme_info = analisi['firme']
             
             if not firme_info:
                 self.mostra_stato_file("error", _("No digital signature found in file"))
                 return
             
+            if analisi['interruzione'] is not None:
+                self.mostra_stato_file("error", _("Analysis interrupted"))
+                self.mostra_errore_verifica(analisi['interruzione']['dettaglio'])
+                return
+            
             # Extract signatures recursively
             max_livello = max(info.get('livello_busta', 1) for info in firme_info)
             file_corrente = file_p7m
@@ -401,7 +407,12 @@ class FirmeWindow(Gtk.ApplicationWindow):
         try:
             with open(file_p7m, 'rb') as f:
                 data = f.read()
-            firme_info = analizza_busta(data)
+            analisi = analizza_buste_annidate(data)
+            firme_info = analisi['firme']
+            
+            if analisi['interruzione'] is not None and firme_info:
+                self.mostra_errore_verifica(analisi['interruzione']['dettaglio'])
+                return
             
             if not firme_info:
                 no_firme_label = Gtk.Label(label=f'<span size="small" color="#999">⚠️ {_("No digital signature found in file")}</span>')
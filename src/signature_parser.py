@@ -4,6 +4,7 @@
 
 from asn1crypto import cms, x509
 import sys
+import time
 import base64
 from datetime import datetime
 import gettext
@@ -20,6 +21,29 @@ gettext.bindtextdomain(APP_ID, LOCALE_DIR)
 gettext.textdomain(APP_ID)
 _ = gettext.gettext
 
+# Default limits for the analysis of nested envelopes
+MAX_LIVELLI_BUSTA = 32
+MAX_BYTE_ANALIZZATI = 1024 * 1024 * 1024
+MAX_SECONDI_ANALISI = 30.0
+
+# DER encoding of the signedData content type OID (1.2.840.113549.1.7.2)
+_OID_SIGNED_DATA = b'\x06\x09\x2a\x86\x48\x86\xf7\x0d\x01\x07\x02'
+
+class _BustaNonDer(Exception):
+    """
+    Raised when an envelope uses BER features (indefinite lengths,
+    constructed content) that cannot be walked by offsets.
+    """
+
+class _LimiteSuperato(Exception):
+    """
+    Raised when one of the analysis limits is exceeded.
+    """
+    def __init__(self, motivo, dettaglio):
+        super().__init__(dettaglio)
+        self.motivo = motivo
+        self.dettaglio = dettaglio
+
 def rileva_formato_p7m(data):
     """
     Detect if the P7M file is in Base64, DER or PEM format.
@@ -50,11 +74,15 @@ def rileva_formato_p7m(data):
     return ('der', data)
 
 def estrai_certificati(signed_data):
-    certs = []
     if 'certificates' in signed_data and signed_data['certificates'] is not None:
-        for cert in signed_data['certificates']:
-            if cert.name == 'certificate':
-                certs.append(cert.chosen)
+        return certificati_da_set(signed_data['certificates'])
+    return []
+
+def certificati_da_set(cert_set):
+    certs = []
+    for cert in cert_set:
+        if cert.name == 'certificate':
+            certs.append(cert.chosen)
     return certs
 
 def cerca_certificato_per_serial(cert_list, serial):
@@ -147,39 +175,199 @@ def mostra_info_firma(signer, cert_list):
     
     return info
 
-def analizza_busta(data, livello=1):
+def _leggi_tlv(buf, pos, fine):
+    """
+    Read the DER header found at offset pos of buf, without going past fine.
+    Returns (tag, content start, content end) as offsets into buf.
+    """
+    if pos + 2 > fine:
+        raise ValueError(_('Truncated ASN.1 data'))
+    tag = buf[pos]
+    lunghezza = buf[pos + 1]
+    pos += 2
+    if lunghezza == 0x80:
+        raise _BustaNonDer()
+    if lunghezza & 0x80:
+        n_byte = lunghezza & 0x7f
+        if n_byte > 8 or pos + n_byte > fine:
+            raise ValueError(_('Invalid ASN.1 length'))
+        lunghezza = int.from_bytes(buf[pos:pos + n_byte], 'big')
+        pos += n_byte
+    if pos + lunghezza > fine:
+        raise ValueError(_('Truncated ASN.1 data'))
+    return tag, pos, pos + lunghezza
+
+def _e_busta_firmata(buf, inizio, fine):
+    """
+    Check whether buf[inizio:fine] starts like a CMS signedData ContentInfo.
+    """
+    if fine - inizio < 2 or buf[inizio] != 0x30:
+        return False
+    lunghezza = buf[inizio + 1]
+    pos = inizio + 2
+    if lunghezza & 0x80 and lunghezza != 0x80:
+        pos += lunghezza & 0x7f
+    return buf[pos:pos + len(_OID_SIGNED_DATA)] == _OID_SIGNED_DATA
+
+def _scomponi_busta_der(buf, inizio, fine):
+    """
+    Locate the parts of a DER signedData envelope by offsets into buf.
+    Returns (certificates range or None, signer infos range, content range or None),
+    where each range is a (start, end) tuple of offsets.
+    """
+    pos, fine_ci = _leggi_tlv(buf, inizio, fine)[1:]
+    pos = _leggi_tlv(buf, pos, fine_ci)[2]  # contentType
+    tag, pos, fine_esplicito = _leggi_tlv(buf, pos, fine_ci)
+    if tag != 0xa0:
+        raise ValueError(_('Missing signed data content'))
+    tag, pos, fine_sd = _leggi_tlv(buf, pos, fine_esplicito)
+    if tag != 0x30:
+        raise ValueError(_('Invalid signed data'))
+    pos = _leggi_tlv(buf, pos, fine_sd)[2]  # version
+    pos = _leggi_tlv(buf, pos, fine_sd)[2]  # digestAlgorithms
+
+    # encapContentInfo: eContentType and optional [0] EXPLICIT eContent
+    contenuto = None
+    tag, pos_eci, fine_eci = _leggi_tlv(buf, pos, fine_sd)
+    if tag != 0x30:
+        raise ValueError(_('Invalid signed data'))
+    pos_eci = _leggi_tlv(buf, pos_eci, fine_eci)[2]  # eContentType
+    if pos_eci < fine_eci:
+        tag, pos_eci, fine_econtent = _leggi_tlv(buf, pos_eci, fine_eci)
+        if tag != 0xa0:
+            raise ValueError(_('Invalid signed data'))
+        tag, inizio_ottetti, fine_ottetti = _leggi_tlv(buf, pos_eci, fine_econtent)
+        if tag != 0x04:
+            raise _BustaNonDer()
+        contenuto = (inizio_ottetti, fine_ottetti)
+    pos = fine_eci
+
+    certificati = None
+    signer_infos = None
+    while pos < fine_sd:
+        inizio_campo = pos
+        campo = _leggi_tlv(buf, pos, fine_sd)
+        tag, pos = campo[0], campo[2]
+        if tag == 0xa0:
+            certificati = (inizio_campo, pos)
+        elif tag == 0x31:
+            signer_infos = (inizio_campo, pos)
+    if signer_infos is None:
+        raise ValueError(_('Missing signer infos'))
+    return certificati, signer_infos, contenuto
+
+def _firme_da_signer_infos(signer_infos, cert_list, livello, firme, controlla_limiti):
+    """
+    Append to firme the information of every signer of an envelope level.
+    controlla_limiti is called with the size of each signer before it is
+    analyzed, and raises _LimiteSuperato to stop the analysis.
+    """
+    for idx, signer in enumerate(signer_infos, 1):
+        controlla_limiti(len(signer.dump()))
+        info_firma = mostra_info_firma(signer, cert_list)
+        info_firma['firmatario_idx'] = idx
+        info_firma['livello_busta'] = livello
+        firme.append(info_firma)
+
+def analizza_buste_annidate(data, max_livelli=MAX_LIVELLI_BUSTA,
+                            max_byte=MAX_BYTE_ANALIZZATI,
+                            max_secondi=MAX_SECONDI_ANALISI):
+    """
+    Analyze a P7M envelope and all the envelopes nested inside it.
+    Automatically supports Base64, DER and PEM format.
+
+    Nested envelopes are walked iteratively by offsets into the original
+    buffer, so no copy of the signed content is made for DER envelopes.
+    The walk stops when one of the limits on nesting depth, total analyzed
+    bytes or elapsed seconds is exceeded.
+
+    Analyzed bytes count the input once, plus every copy handed to
+    asn1crypto (certificates, signer infos and BER envelopes with their
+    decoded content). Limits are checked before each level and before each
+    signer, so the analysis of a single signer is never interrupted.
+
+    Returns a dictionary with:
+    - 'firme': list of signature information, as returned by analizza_busta
+    - 'interruzione': None if the whole envelope was analyzed, otherwise a
+      dictionary with 'motivo' ('profondita', 'byte', 'tempo' or
+      'formato_non_valido'), 'livello' and 'dettaglio'
+    """
+    firme = []
+    inizio_analisi = time.monotonic()
+    formato, data = rileva_formato_p7m(data)
+    buf = memoryview(data)
+    inizio, fine = 0, len(buf)
+    byte_analizzati = len(buf)
+    livello = 1
+
+    def interrompi(motivo, dettaglio):
+        return {'firme': firme, 'interruzione': {
+            'motivo': motivo, 'livello': livello, 'dettaglio': dettaglio}}
+
+    def controlla_limiti(n_byte=0):
+        nonlocal byte_analizzati
+        byte_analizzati += n_byte
+        if byte_analizzati > max_byte:
+            raise _LimiteSuperato('byte', _('Analyzed data exceeds %d bytes') % max_byte)
+        if time.monotonic() - inizio_analisi > max_secondi:
+            raise _LimiteSuperato('tempo', _('Analysis exceeds %g seconds') % max_secondi)
+
+    while True:
+        if not _e_busta_firmata(buf, inizio, fine):
+            if livello == 1:
+                return interrompi('formato_non_valido', _('File is not in valid P7M/CAdES format'))
+            # The content of the innermost envelope has been reached
+            break
+        if livello > max_livelli:
+            return interrompi('profondita', _('Envelope nesting exceeds %d levels') % max_livelli)
+
+        try:
+            controlla_limiti()
+            try:
+                certificati, signer_infos, contenuto = _scomponi_busta_der(buf, inizio, fine)
+            except _BustaNonDer:
+                # BER envelope: let asn1crypto rebuild the content in a new buffer
+                if (inizio, fine) == (0, len(buf)) and isinstance(buf.obj, bytes):
+                    dati_livello = buf.obj
+                else:
+                    dati_livello = bytes(buf[inizio:fine])
+                    byte_analizzati += len(dati_livello)
+                content_info = cms.ContentInfo.load(dati_livello)
+                signed_data = content_info['content']
+                _firme_da_signer_infos(signed_data['signer_infos'], estrai_certificati(signed_data),
+                                       livello, firme, controlla_limiti)
+                encap_content = signed_data['encap_content_info']['content']
+                if encap_content is None:
+                    break
+                buf = memoryview(encap_content.native)
+                inizio, fine = 0, len(buf)
+                byte_analizzati += len(buf)
+            else:
+                cert_list = []
+                if certificati is not None:
+                    byte_analizzati += certificati[1] - certificati[0]
+                    cert_set = cms.CertificateSet.load(
+                        bytes(buf[certificati[0]:certificati[1]]), implicit=0)
+                    cert_list = certificati_da_set(cert_set)
+                signer_set = cms.SignerInfos.load(bytes(buf[signer_infos[0]:signer_infos[1]]))
+                _firme_da_signer_infos(signer_set, cert_list, livello, firme, controlla_limiti)
+                if contenuto is None:
+                    break
+                inizio, fine = contenuto
+        except _LimiteSuperato as e:
+            return interrompi(e.motivo, e.dettaglio)
+        except Exception as e:
+            return interrompi('formato_non_valido', str(e))
+        livello += 1
+
+    return {'firme': firme, 'interruzione': None}
+
+def analizza_busta(data):
     """
     Analyze a P7M envelope (including nested) and extract signature information.
     Automatically supports Base64, DER and PEM format.
     """
-    risultati = []
-    
-    # Detect and convert format if necessary
-    if livello == 1:  # Only at first level
-        formato, data_convertita = rileva_formato_p7m(data)
-        data = data_convertita
-    
-    try:
-        content_info = cms.ContentInfo.load(data)
-        if content_info['content_type'].native == 'signed_data':
-            signed_data = content_info['content']
-            cert_list = estrai_certificati(signed_data)
-            signer_infos = signed_data['signer_infos']
-            for idx, signer in enumerate(signer_infos, 1):
-                info_firma = mostra_info_firma(signer, cert_list)
-                info_firma['firmatario_idx'] = idx
-                info_firma['livello_busta'] = livello
-                risultati.append(info_firma)
-            # Look for nested data (content)
-            encap_content = signed_data['encap_content_info']['content']
-            if encap_content is not None:
-                try:
-                    risultati += analizza_busta(encap_content.native, livello + 1)
-                except Exception:
-                    pass
-    except Exception:
-        pass
-    return risultati
+    return analizza_buste_annidate(data)['firme']
 
 def stampa_risultati(risultati):
     for info in risultati:
@@ -195,5 +383,7 @@ if __name__ == "__main__":
     else:
         with open(sys.argv[1], 'rb') as f:
             data = f.read()
-        risultati = analizza_busta(data)
-        stampa_risultati(risultati)
+        analisi = analizza_buste_annidate(data)
+        stampa_risultati(analisi['firme'])
+        if analisi['interruzione'] is not None:
+            print(f"\n{_('Analysis interrupted')}: {analisi['interruzione']['dettaglio']}")